@@ -11,14 +11,33 @@ Tested on WebUI v1.8.1 + ControlNet v1.2.2 (API).
 
 import os
 import random
+import asyncio
 import argparse
-import requests
-from PIL import Image, ImageDraw
+import httpx
+import orjson
+import ijson
+import hashlib
+import diskcache
+import numpy as np
+from PIL import Image
 import base64
 from io import BytesIO
 import itertools
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-API_URL = "http://127.0.0.1:7860/sdapi/v1/img2img"
+try:  # libjpeg-turbo SIMD JPEG çözücü; paket ya da libturbojpeg yoksa PIL kullanılır
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+API_BASE = "http://127.0.0.1:7860"
+IMG2IMG_PATH = "/sdapi/v1/img2img"
+JSON_HEADERS = {"Content-Type": "application/json"}
+_tls = threading.local()  # encode_image için thread başına BytesIO
+_save_pool = ThreadPoolExecutor(max_workers=2)  # kayıtlar encode thread'lerinden ayrı
 
 # ——— Hyper‑parameters ————————————————————————————————————————————
 MASK_MIN_FRAC, MASK_MAX_FRAC = 0.20, 0.50   # %20‑%50 arası rastgele kutu
@@ -30,12 +49,58 @@ COLOR_MODEL   = "control_v1p_sd15_color [c86c5ea7]"
 DEPTH_MODEL   = "control_v11p_sd15_depth [cfd03158]"
 PROMPT_SUFFIX = (", warm orange glow reflected on nearby surfaces, realistic soft shadows, ""physically accurate light falloff, global cinematic color grading")
 NEG_SUFFIX = ", oversaturated colors, posterization, pure orange blob, glowing mush"
+ENCODE_CACHE_SIZE = 128                     # base64 önbelleğindeki en fazla görsel
+IMAGE_EXTS = frozenset(("png", "jpg", "jpeg"))
+PREFETCH_DEPTH = 2                          # GPU meşgulken önceden hazırlanan iş sayısı
 # ————————————————————————————————————————————————————————————————
 
+def open_client(concurrency: int) -> httpx.AsyncClient:
+    """Tüm istekler için tek, keep-alive bağlantı havuzu (istek başına yeni TCP yok).
+    WebUI işleri tek tek yürütür: yanıt, kuyrukta önündeki işleri de bekler."""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=API_BASE, headers=JSON_HEADERS, limits=limits,
+                             timeout=httpx.Timeout(300, read=300 * concurrency))
+
+
 def encode_image(image: Image.Image) -> str:
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+    # Tampon yeniden kullanılır: truncate yok (kapasiteyi küçültür), geçerli veri ilk tell() bayt
+    buffered = getattr(_tls, "buf", None)
+    if buffered is None:
+        buffered = _tls.buf = BytesIO()
+    buffered.seek(0)
+    if image.mode in ("1", "L"):  # maske: düz alanlar en hızlı zlib ile de küçük
+        image.save(buffered, format="PNG", compress_level=1)
+    else:
+        image.save(buffered, format="WEBP", lossless=True, quality=0, method=0)  # kayıpsız, PNG'den hızlı
+    size = buffered.tell()
+    with buffered.getbuffer() as view, view[:size] as data:  # tekrar yazılmadan önce bırakılır
+        return base64.b64encode(data).decode()
+
+
+def open_rgb(path: str) -> Image.Image:
+    """Görseli RGB açar; JPEG'ler varsa TurboJPEG ile çözülür."""
+    if _tj is not None and path.rpartition(".")[2].lower() in ("jpg", "jpeg"):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return Image.fromarray(_tj.decode(data, pixel_format=TJPF_RGB))
+        except OSError:  # CMYK ya da uzantısı yanlış dosya → PIL yolu
+            pass
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def _encode_path_cached(path: str, mtime: float) -> str:
+    with open_rgb(path) as img:
+        return encode_image(img)
+
+
+def encode_path(path: str, cached: bool = True) -> str:
+    """Diskteki görseli encode eder; `cached` ise dosya değişmedikçe önbellekten döner."""
+    if not cached:
+        return _encode_path_cached.__wrapped__(path, 0.0)
+    return _encode_path_cached(path, os.path.getmtime(path))
 
 
 def load_prompts(prompt_file):
@@ -45,17 +110,29 @@ def load_prompts(prompt_file):
         return [p.strip() for p in f.read().splitlines() if p.strip()]
 
 
-def create_mask(image: Image.Image) -> tuple[Image.Image, tuple, tuple]:
+def list_images(folder: str) -> list[str]:
+    """Klasördeki png/jpg/jpeg dosyaları; scandir'in önbellekli tür bilgisiyle, isme göre sıralı
+    (aynı --seed farklı dosya sistemlerinde de aynı sırayı görsün diye)."""
+    with os.scandir(folder) as entries:
+        return sorted(e.name for e in entries
+                      if e.is_file() and e.name.rpartition(".")[2].lower() in IMAGE_EXTS)
+
+
+def create_mask(image: Image.Image, rng: random.Random) -> tuple[Image.Image, tuple, tuple]:
     """Rastgele boyutlu dikdörtgen maske (YOLO box + bbox)"""
     w, h = image.size
-    box_w = random.randint(int(w * MASK_MIN_FRAC), int(w * MASK_MAX_FRAC))
-    box_h = random.randint(int(h * MASK_MIN_FRAC), int(h * MASK_MAX_FRAC))
-    x0 = random.randint(0, w - box_w)
-    y0 = random.randint(0, h - box_h)
+    box_w = rng.randint(int(w * MASK_MIN_FRAC), int(w * MASK_MAX_FRAC))
+    box_h = rng.randint(int(h * MASK_MIN_FRAC), int(h * MASK_MAX_FRAC))
+    x0 = rng.randint(0, w - box_w)
+    y0 = rng.randint(0, h - box_h)
     x1, y1 = x0 + box_w, y0 + box_h
 
-    mask = Image.new("L", (w, h), 0)
-    ImageDraw.Draw(mask).rectangle([x0, y0, x1, y1], fill=255)
+    # ImageDraw.rectangle yerine numpy dilim ataması (uç noktalar dahil → +1)
+    arr = np.zeros((h, w), dtype=np.uint8)
+    arr[y0:y1 + 1, x0:x1 + 1] = 255
+    # "1" moduna çevrilmiyor: maske Lineart ünitesine de gidiyor ve ControlNet
+    # 1-bit PNG'yi 0/1 değerli diziye çözüyor (0/255 yerine)
+    mask = Image.fromarray(arr)  # 2 boyutlu uint8 → "L" modu
 
     # YOLO format (class cx cy w h) normalized
     yolo_box = (
@@ -68,53 +145,124 @@ def create_mask(image: Image.Image) -> tuple[Image.Image, tuple, tuple]:
     return mask, yolo_box, (x0, y0, x1, y1)
 
 
+# 3‑lü ControlNet bloğu: Lineart (ateş), Color, Depth. Sabit alanlar modül
+# yüklenirken bir kez kurulur; çağrı başına sadece "input_image" eklenir.
+_CN_TEMPLATE = (
+    # 1) Fire mask → Lineart (kuvvetli)
+    {
+        "module": "lineart",
+        "model": LINEART_MODEL,
+        "weight": 1.0,
+        "resize_mode": 1,
+        "low_vram": True,
+        "guess_mode": False,
+        "control_mode": 0,
+        "conditioning_scale": 1.0,
+    },
+    # 2) Arka plan → Color reference‑only (stil/LUT aktarımı)
+    {
+        "module": "reference_only",
+        "model": COLOR_MODEL,
+        "weight": 0.8,
+        "resize_mode": 0,
+        "low_vram": True,
+        "guess_mode": False,
+        "control_mode": 0,
+        "conditioning_scale": 1.0,
+    },
+    # 3) Arka plan → Depth (ışık & gölge hizalama)
+    {
+        "module": "depth",
+        "model": DEPTH_MODEL,
+        "weight": 0.5,
+        "resize_mode": 0,
+        "low_vram": True,
+        "guess_mode": True,
+        "control_mode": 0,
+        "conditioning_scale": 1.0,
+    },
+)
+
+
 def build_controlnet_units(init_img_b64: str, fire_mask_b64: str) -> list[dict]:
-    """3‑lü ControlNet bloğu: Lineart (ateş), Color, Depth"""
+    """3‑lü ControlNet bloğu: Lineart (ateş), Color, Depth.
+    Color/Depth aynı `init_img_b64` str nesnesini referansla paylaşır; kopya yapılmaz."""
+    line, color, depth = _CN_TEMPLATE
     return [
-        # 1) Fire mask → Lineart (kuvvetli)
-        {
-            "input_image": fire_mask_b64,
-            "module": "lineart",
-            "model": LINEART_MODEL,
-            "weight": 1.0,
-            "resize_mode": 1,
-            "low_vram": True,
-            "guess_mode": False,
-            "control_mode": 0,
-            "conditioning_scale": 1.0,
-        },
-        # 2) Arka plan → Color reference‑only (stil/LUT aktarımı)
-        {
-            "input_image": init_img_b64,
-            "module": "reference_only",
-            "model": COLOR_MODEL,
-            "weight": 0.8,
-            "resize_mode": 0,
-            "low_vram": True,
-            "guess_mode": False,
-            "control_mode": 0,
-            "conditioning_scale": 1.0,
-        },
-        # 3) Arka plan → Depth (ışık & gölge hizalama)
-        {
-            "input_image": init_img_b64,
-            "module": "depth",
-            "model": DEPTH_MODEL,
-            "weight": 0.5,
-            "resize_mode": 0,
-            "low_vram": True,
-            "guess_mode": True,
-            "control_mode": 0,
-            "conditioning_scale": 1.0,
-        },
+        {"input_image": fire_mask_b64, **line},
+        {"input_image": init_img_b64, **color},
+        {"input_image": init_img_b64, **depth},
     ]
 
 
-def send_to_api(init_img: Image.Image, fire_mask: Image.Image, prompt: str, negative_prompt: str):
-    init_b64 = encode_image(init_img)
-    mask_b64 = encode_image(fire_mask)
+# ——— Pipeline: hazırla (thread) → API (async) → çöz + kaydet (thread) ————————————
+
+def prepare_inputs(img_path: str, cache_init: bool, rng: random.Random) -> tuple[str, tuple[int, int], str, tuple]:
+    """CPU aşaması: init base64 + rastgele maske + maske base64."""
+    init_b64 = encode_path(img_path, cache_init)
+    with Image.open(img_path) as bg_img:  # maske için sadece boyut lazım, piksel çözülmez
+        mask, yolo_box, _ = create_mask(bg_img, rng)
+        size = bg_img.size
+    return init_b64, size, encode_image(mask), yolo_box
+
+
+def decode_images(img_datas: list[str]) -> list[Image.Image]:
+    outs = []
+    for img_data in img_datas:
+        # data-URI öneki varsa sadece ilk 32 karakterde aranır; yoksa find -1 → [0:] kopyasız aynı str
+        img_b64 = img_data[img_data.find(",", 0, 32) + 1:]
+        outs.append(Image.open(BytesIO(base64.b64decode(img_b64))))
+    return outs
+
+
+def save_outputs(out_imgs: list[Image.Image], yolo_box: tuple, output_dir: str, start: int) -> list[str]:
+    """Görselleri ve YOLO etiketlerini yazar; kaydedilen yolları döndürür (log event loop'ta basılır)."""
+    out_paths = []
+    for i, out_img in enumerate(out_imgs, start + 1):
+        out_path = os.path.join(output_dir, f"out_{i}.png")
+        out_img.save(out_path, format="PNG", compress_level=1)
+        with open(os.path.join(output_dir, f"out_{i}.txt"), "w", encoding="utf-8") as f:
+            f.write(" ".join(map(str, yolo_box)))
+        out_paths.append(out_path)
+    return out_paths
+
+
+class _StreamReader:
+    """httpx yanıt akışını ijson'un beklediği async read() arayüzüne uyarlar."""
+
+    def __init__(self, resp: httpx.Response):
+        self._chunks = resp.aiter_bytes()
+
+    async def read(self, n: int = -1) -> bytes:
+        if n == 0:  # ijson bytes/str ayrımı için read(0) çağırıyor
+            return b""
+        return await anext(self._chunks, b"")
+
+    async def drain(self):
+        async for _ in self._chunks:
+            pass
+
+
+async def read_images(resp: httpx.Response, batch_size: int) -> list[str]:
+    """İlk `batch_size` görseli gövde gelirken ayrıştırır. Kalan kısım (ControlNet
+    detect map'leri, info) tokenize edilmeden okunup atılır; bağlantı havuza döner."""
+    reader = _StreamReader(resp)
+    images = []
+    async for img_data in ijson.items(reader, "images.item"):
+        images.append(img_data)
+        if len(images) == batch_size:
+            break
+    await reader.drain()
+    return images
+
+
+async def send_to_api(client: httpx.AsyncClient, cache: diskcache.Cache | None, init_b64: str,
+                      size: tuple[int, int], mask_b64: str, prompt: str, negative_prompt: str,
+                      seed: int, batch_size: int = 1) -> list[Image.Image]:
+    """Aynı init/maske/prompt ile tek çağrıda `batch_size` görsel üretir.
+    Birebir aynı istek gövdesi daha önce gönderildiyse sonuç disk önbelleğinden gelir."""
     payload = {
-        "init_images": [init_b64],
+        "init_images": [init_b64],  # encode_path'ten gelen tek str; ControlNet birimleri de aynısını kullanır
         "mask": mask_b64,
         "mask_blur": MASK_BLUR_PX,
         "denoising_strength": DENOISE_STRENGTH,
@@ -126,19 +274,66 @@ def send_to_api(init_img: Image.Image, fire_mask: Image.Image, prompt: str, nega
         "sampler_name": "Euler",
         "steps": 20,
         "cfg_scale": 7,
-        "width": init_img.size[0],
-        "height": init_img.size[1],
+        "seed": seed,  # sabit seed → aynı girdi aynı çıktı (önbellek + tekrar üretilebilirlik)
+        "batch_size": batch_size,
+        "n_iter": 1,
+        "width": size[0],
+        "height": size[1],
         "controlnet_units": build_controlnet_units(init_b64, mask_b64),
     }
 
-    resp = requests.post(API_URL, json=payload, timeout=300)
-    resp.raise_for_status()
-    img_data = resp.json()["images"][0]
-    img_b64 = img_data.split(",", 1)[1] if "," in img_data else img_data
-    return Image.open(BytesIO(base64.b64decode(img_b64)))
+    body = orjson.dumps(payload)
+    key = hashlib.blake2b(body, digest_size=16).hexdigest()
+    img_datas = await asyncio.to_thread(cache.get, key) if cache is not None else None
+    if img_datas is None:
+        async with client.stream("POST", IMG2IMG_PATH, content=body) as resp:
+            resp.raise_for_status()
+            # ControlNet detect map'leri listenin sonuna eklenebilir → ilk batch_size görsel
+            img_datas = await read_images(resp, batch_size)
+        if cache is not None:
+            await asyncio.to_thread(cache.set, key, img_datas)
+    return await asyncio.to_thread(decode_images, img_datas)
+
+
+async def generate_batch(client: httpx.AsyncClient, cache: diskcache.Cache | None, net: asyncio.Semaphore,
+                         args, start: int, n: int, img_name: str, rng: random.Random, cache_init: bool,
+                         prompts: list[str], neg_prompts: list[str]):
+    """Bir API çağrısı: maske → n görsel → out_{start+1}..out_{start+n}.
+    CPU aşamaları event loop'u bloklamaz; `net` yalnızca uçuştaki istekleri sınırlar.
+    `rng` bu işe özel: zamanlama sırası ne olursa olsun aynı --seed aynı sonucu verir."""
+    prompt = rng.choice(prompts)
+    neg = rng.choice(neg_prompts) if neg_prompts else ""
+    seed = rng.randrange(2**31)
+    init_b64, size, mask_b64, yolo_box = await asyncio.to_thread(
+        prepare_inputs, os.path.join(args.input_dir, img_name), cache_init, rng)
 
+    async with net:
+        out_imgs = await send_to_api(client, cache, init_b64, size, mask_b64, prompt, neg, seed, n)
+    out_paths = await asyncio.get_running_loop().run_in_executor(
+        _save_pool, save_outputs, out_imgs, yolo_box, args.output_dir, start)
+    for out_path in out_paths:
+        print(f"[✓] Kayıt: {out_path}")
 
-def main():
+
+async def worker(client: httpx.AsyncClient, cache: diskcache.Cache | None, net: asyncio.Semaphore, args, jobs,
+                 cache_init: bool, prompts: list[str], neg_prompts: list[str]) -> int:
+    """Ortak `jobs` yineleyicisinden sırayla iş çeker; üretilemeyen görsel sayısını döndürür.
+    Hatalı iş raporlanıp atlanır, API'ye bağlanılamıyorsa (ConnectError) çalışma durur."""
+    failed = 0
+    for start, img_name, job_seed in jobs:
+        n = min(args.batch_size, args.count - start)
+        try:
+            await generate_batch(client, cache, net, args, start, n, img_name, random.Random(job_seed),
+                                 cache_init, prompts, neg_prompts)
+        except httpx.ConnectError:
+            raise
+        except Exception as e:
+            failed += n
+            print(f"[✗] {img_name} → out_{start + 1}: {e!r}")
+    return failed
+
+
+async def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("-c", "--count", type=int, required=True)
     ap.add_argument("-p", "--prompt_file", default="prompt.txt")
@@ -146,30 +341,58 @@ def main():
     ap.add_argument("-o", "--output_dir", default="output")
     ap.add_argument("-i", "--input_dir", default="input")
     ap.add_argument("-ci", "--control_dir", default="control")
+    ap.add_argument("-j", "--concurrency", type=int, default=4)
+    ap.add_argument("-bs", "--batch_size", type=int, default=1)  # aynı init+maske+prompt ile çağrı başına görsel
+    ap.add_argument("--cache_dir", default=".sd_cache")  # "" → önbellek kapalı
+    ap.add_argument("--seed", type=int, default=0)
     args = ap.parse_args()
+    if args.concurrency < 1:
+        ap.error("--concurrency en az 1 olmalı")
+    if args.batch_size < 1:
+        ap.error("--batch_size en az 1 olmalı")
 
     os.makedirs(args.output_dir, exist_ok=True)
     prompts = load_prompts(args.prompt_file) or ["fire"]
     neg_prompts = load_prompts(args.neg_prompt_file)
 
-    imgs = [f for f in os.listdir(args.input_dir) if f.lower().endswith(("png", "jpg", "jpeg"))]
-    ctrls = [f for f in os.listdir(args.control_dir) if f.lower().endswith(("png", "jpg", "jpeg"))]
+    imgs = list_images(args.input_dir)
+    ctrls = list_images(args.control_dir)
     if not imgs or not ctrls:
         raise SystemExit("Input / Control klasörleri boş!")
 
-    for i, img_name in enumerate(itertools.islice(itertools.cycle(imgs), args.count), 1):
-        with Image.open(os.path.join(args.input_dir, img_name)).convert("RGB") as bg_img:
-            mask, yolo_box, _ = create_mask(bg_img)
-            prompt = random.choice(prompts)
-            neg = random.choice(neg_prompts) if neg_prompts else ""
-
-            out_img = send_to_api(bg_img, mask, prompt, neg)
-            out_path = os.path.join(args.output_dir, f"out_{i}.png")
-            out_img.save(out_path)
-            with open(os.path.join(args.output_dir, f"out_{i}.txt"), "w", encoding="utf-8") as f:
-                f.write(" ".join(map(str, yolo_box)))
-            print(f"[✓] Kayıt: {out_path}")
+    starts = range(0, args.count, args.batch_size)
+    # İş seed'leri iş sırasıyla çekilir → sonuç -j'den bağımsız
+    rng = random.Random(args.seed)
+    # Worker'lar ortak yineleyiciden iş çeker: bellekte iş başına görev birikmez.
+    # -j'den PREFETCH_DEPTH fazla worker var → sıradaki işlerin girdileri GPU beklenirken hazırlanır
+    jobs = ((start, img_name, rng.randrange(2**32))
+            for start, img_name in zip(starts, itertools.cycle(imgs)))
+    # cycle sırasında LRU ancak girdiler tekrar geliyorsa ve hepsi önbelleğe sığıyorsa isabet eder
+    cache_init = len(starts) > len(imgs) and len(imgs) <= ENCODE_CACHE_SIZE
+    net = asyncio.Semaphore(args.concurrency)
+    cache = diskcache.Cache(args.cache_dir) if args.cache_dir else None
+    try:
+        async with open_client(args.concurrency) as client:
+            workers = [asyncio.ensure_future(worker(client, cache, net, args, jobs, cache_init,
+                                                    prompts, neg_prompts))
+                       for _ in range(args.concurrency + PREFETCH_DEPTH)]
+            try:
+                failed = sum(await asyncio.gather(*workers))
+            except httpx.ConnectError:
+                # net'i bekleyen worker'lar istemci kapanmadan durdurulur
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+    except httpx.ConnectError as e:
+        raise SystemExit(f"API'ye bağlanılamadı: {e}")
+    finally:
+        _save_pool.shutdown(wait=True)
+        if cache is not None:
+            cache.close()
+    if failed:
+        raise SystemExit(f"{failed} görsel üretilemedi")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
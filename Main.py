@@ -1,18 +1,79 @@
 import os
 import random
+import asyncio
 import argparse
-import requests
-from PIL import Image, ImageDraw
+import httpx
+import orjson
+import ijson
+import hashlib
+import diskcache
+import numpy as np
+from PIL import Image
 import base64
 from io import BytesIO
 import itertools
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-API_URL = "http://127.0.0.1:7860/sdapi/v1/img2img"
+# TurboJPEG opsiyonel: paket ya da libturbojpeg kurulu değilse JPEG'ler de PIL ile açılıyor
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+API_BASE = "http://127.0.0.1:7860"
+IMG2IMG_PATH = "/sdapi/v1/img2img"
+JSON_HEADERS = {"Content-Type": "application/json"}
+_tls = threading.local()  # thread başına yeniden kullanılan BytesIO
+_save_pool = ThreadPoolExecutor(max_workers=2)  # çıktı kayıtları için ayrı havuz
+IMAGE_EXTS = frozenset(('png', 'jpg', 'jpeg'))
+
+def open_client(concurrency):
+    # Tüm istekler için tek, keep-alive bağlantı havuzu (istek başına yeni TCP yok)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=API_BASE, headers=JSON_HEADERS, limits=limits, timeout=None)
 
 def encode_image(image: Image.Image) -> str:
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+    # Thread'in tamponu baştan üzerine yazılıyor, truncate edilmiyor; sadece ilk tell() bayt geçerli
+    buffered = getattr(_tls, "buf", None)
+    if buffered is None:
+        buffered = _tls.buf = BytesIO()
+    buffered.seek(0)
+    if image.mode in ("1", "L"):  # maskeler hızlı zlib PNG olarak gidiyor
+        image.save(buffered, format="PNG", compress_level=1)
+    else:
+        image.save(buffered, format="WEBP", lossless=True, quality=0, method=0)  # kayıpsız, PNG'den hızlı
+    size = buffered.tell()
+    with buffered.getbuffer() as view, view[:size] as data:  # kopyasız, eski baytlar okunmuyor
+        return base64.b64encode(data).decode()
+
+ENCODE_CACHE_SIZE = 128  # base64 önbelleğindeki en fazla görsel
+PREFETCH_DEPTH = 2  # GPU meşgulken girdileri önceden hazırlanan iş sayısı
+
+def open_rgb(path):
+    # JPEG'ler varsa TurboJPEG ile, diğerleri PIL ile çözülüyor
+    if _tj is not None and path.rpartition('.')[2].lower() in ('jpg', 'jpeg'):
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            return Image.fromarray(_tj.decode(data, pixel_format=TJPF_RGB))
+        except OSError:  # TurboJPEG çözemediyse (CMYK, yanlış uzantı) PIL deniyor
+            pass
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def _encode_path_cached(path: str, mtime: float) -> str:
+    with open_rgb(path) as img:
+        return encode_image(img)
+
+def encode_path(path: str, cached: bool = True) -> str:
+    # Aynı giriş/control dosyası her çağrıda yeniden encode edilmesin diye (path, mtime) ile önbellekli
+    if not cached:
+        return _encode_path_cached.__wrapped__(path, 0.0)
+    return _encode_path_cached(path, os.path.getmtime(path))
 
 def load_prompts(prompt_file):
     if not os.path.exists(prompt_file):
@@ -20,23 +81,32 @@ def load_prompts(prompt_file):
     with open(prompt_file, 'r', encoding='utf-8') as f:
         return [p.strip() for p in f.read().splitlines() if p.strip()]
 
-def create_mask(image: Image.Image, prompt: str = "") -> (Image.Image, tuple, tuple):
+def list_images(folder):
+    # scandir: tür bilgisi dizin girdisinden gelir, ekstra stat yok. İsme göre sıralı,
+    # böylece aynı --seed farklı dosya sistemlerinde de aynı sırayı görüyor
+    with os.scandir(folder) as entries:
+        return sorted(e.name for e in entries
+                      if e.is_file() and e.name.rpartition('.')[2].lower() in IMAGE_EXTS)
+
+def create_mask(image: Image.Image, rng: random.Random, prompt: str = "") -> (Image.Image, tuple, tuple):
     width, height = image.size
 
     # --- rastgele boyut sınırları ---
     MIN_FRAC, MAX_FRAC = 0.20, 0.50          # %20‑%50 arası
-    box_w = random.randint(int(width  * MIN_FRAC), int(width  * MAX_FRAC))
-    box_h = random.randint(int(height * MIN_FRAC), int(height * MAX_FRAC))
+    box_w = rng.randint(int(width  * MIN_FRAC), int(width  * MAX_FRAC))
+    box_h = rng.randint(int(height * MIN_FRAC), int(height * MAX_FRAC))
     # ---------------------------------
 
     # Kutunun sol‑üst köşesini, kutu tamamen kadraj içinde kalacak şekilde seç
-    x0 = random.randint(0, width  - box_w)
-    y0 = random.randint(0, height - box_h)
+    x0 = rng.randint(0, width  - box_w)
+    y0 = rng.randint(0, height - box_h)
     x1, y1 = x0 + box_w, y0 + box_h
 
-    # Maske resmi
-    mask = Image.new("L", (width, height), 0)
-    ImageDraw.Draw(mask).rectangle([x0, y0, x1, y1], fill=255)
+    # Maske resmi (numpy dilim ataması; ImageDraw.rectangle gibi uç noktalar dahil)
+    # 1-bit ("1" modu): WebUI maskeyi zaten L'ye çeviriyor, PNG'si birkaç yüz bayt
+    arr = np.zeros((height, width), dtype=bool)
+    arr[y0:y1 + 1, x0:x1 + 1] = True
+    mask = Image.fromarray(arr)  # bool → "1" modu
 
     # YOLO formatına dönüştür (class, cx, cy, w, h) — normalize
     center_x = (x0 + x1) / 2 / width
@@ -48,10 +118,69 @@ def create_mask(image: Image.Image, prompt: str = "") -> (Image.Image, tuple, tu
     return mask, yolo_box, (x0, y0, x1, y1)
 
 
-def send_to_api(init_img, control_img, mask_img, prompt, negative_prompt):
+# Pipeline: hazırla (thread) -> API (async) -> çöz + kaydet (thread)
+def prepare_inputs(image_path, control_image_path, prompt, rng, cache_init):
+    init_b64 = encode_path(image_path, cache_init)
+    control_b64 = encode_path(control_image_path)
+    with Image.open(image_path) as init_img:  # maske için sadece boyut lazım, piksel çözülmüyor
+        mask, yolo_box, box_coords = create_mask(init_img, rng, prompt)
+    return init_b64, control_b64, encode_image(mask), yolo_box, box_coords
+
+def decode_images(img_datas):
+    images = []
+    for img_data in img_datas:
+        # data-URI öneki varsa sadece ilk 32 karakterde aranıyor; yoksa find -1 → [0:] kopyasız aynı str
+        img_base64 = img_data[img_data.find(",", 0, 32) + 1:]
+        images.append(Image.open(BytesIO(base64.b64decode(img_base64))))
+    return images
+
+class _StreamReader:
+    # httpx yanıt akışını ijson'un beklediği async read() arayüzüne uyarlar
+    def __init__(self, resp):
+        self._chunks = resp.aiter_bytes()
+
+    async def read(self, n=-1):
+        if n == 0:  # ijson bytes/str ayrımı için read(0) çağırıyor
+            return b""
+        return await anext(self._chunks, b"")
+
+    async def drain(self):
+        async for _ in self._chunks:
+            pass
+
+async def read_images(resp, batch_size):
+    # İlk batch_size görsel gövde gelirken ayrıştırılıyor; kalan kısım (ControlNet detect map'leri, info)
+    # tokenize edilmeden okunup atılıyor, böylece bağlantı keep-alive havuzuna geri dönüyor
+    reader = _StreamReader(resp)
+    images = []
+    async for img_data in ijson.items(reader, "images.item"):
+        images.append(img_data)
+        if len(images) == batch_size:
+            break
+    await reader.drain()
+    return images
+
+def save_outputs(output_imgs, yolo_box, box_coords, output_dir, start):
+    # Log satırları thread'lerde karışmasın diye burada basılmıyor, yollar geri dönüyor
+    saved = []
+    for i, output_img in enumerate(output_imgs, start + 1):
+        # Üretilen resmin üzerine kırmızı kutu çiziliyor.
+        #draw = ImageDraw.Draw(output_img)
+        #draw.rectangle(box_coords, outline="red", width=3)
+
+        output_path = os.path.join(output_dir, f"out_{i}.png")
+        output_img.save(output_path, format="PNG", compress_level=1)
+        # Kayıt edilen resmin yanına YOLO koordinatlarını içeren txt dosyası oluşturuluyor.
+        annotation_path = os.path.join(output_dir, f"out_{i}.txt")
+        with open(annotation_path, "w", encoding="utf-8") as f:
+            f.write(" ".join(str(val) for val in yolo_box))
+        saved.append((output_path, annotation_path))
+    return saved
+
+async def send_to_api(client, cache, init_b64, control_b64, mask_b64, prompt, negative_prompt, seed, batch_size=1):
     payload = {
-        "init_images": [encode_image(init_img)],
-        "mask": encode_image(mask_img),
+        "init_images": [init_b64],
+        "mask": mask_b64,
         "prompt": prompt,
         "negative_prompt": negative_prompt,
         "denoising_strength": 0.45,
@@ -61,10 +190,13 @@ def send_to_api(init_img, control_img, mask_img, prompt, negative_prompt):
         "sampler_name": "Euler",
         "steps": 20,
         "cfg_scale": 7,
+        "seed": seed,  # sabit seed: aynı girdi → aynı çıktı (önbellek + tekrar üretilebilirlik)
+        "batch_size": batch_size,
+        "n_iter": 1,
         "width": 640,
         "height": 640,
         "controlnet_units": [{
-            "input_image": encode_image(control_img),
+            "input_image": control_b64,
             "module": "lineart",
             "model": "control_v11p_sd15_lineart [43d4be0d]",
             "weight": 1,
@@ -76,70 +208,131 @@ def send_to_api(init_img, control_img, mask_img, prompt, negative_prompt):
         }]
     }
 
-    response = requests.post(API_URL, json=payload)
-    if response.status_code == 200:
-        result = response.json()
-        img_data = result['images'][0]
-        if "," in img_data:
-            img_base64 = img_data.split(",", 1)[1]
-        else:
-            img_base64 = img_data
-        return Image.open(BytesIO(base64.b64decode(img_base64)))
-    else:
-        print(f"[!] Error {response.status_code}: {response.text}")
-        return None
+    body = orjson.dumps(payload)
+    # Birebir aynı istek gövdesi daha önce gönderildiyse sonuç disk önbelleğinden geliyor
+    key = hashlib.blake2b(body, digest_size=16).hexdigest()
+    img_datas = await asyncio.to_thread(cache.get, key) if cache is not None else None
+    if img_datas is None:
+        async with client.stream("POST", IMG2IMG_PATH, content=body) as response:
+            if response.status_code == 200:
+                # ControlNet detect map'leri listenin sonuna eklenebilir, sadece ilk batch_size görsel alınıyor
+                img_datas = await read_images(response, batch_size)
+            else:
+                await response.aread()
+                print(f"[!] Error {response.status_code}: {response.text}")
+                return None
+        if cache is not None:
+            await asyncio.to_thread(cache.set, key, img_datas)
+    return await asyncio.to_thread(decode_images, img_datas)
+
+async def generate_batch(client, cache, net, args, start, n, image_name, rng, cache_init,
+                         prompts, negative_prompts, control_images):
+    # Aynı init görseli, maske ve prompt ile tek çağrıda n görsel: out_{start+1} .. out_{start+n}
+    # CPU aşamaları thread havuzunda, böylece diğer istekler beklerken event loop bloklanmıyor.
+    # net sadece POST'u sınırlıyor; hazırlık ve kayıt onun dışında.
+    # rng bu işe özel, böylece zamanlama sırasından bağımsız olarak aynı --seed aynı sonucu veriyor
+    image_path = os.path.join(args.input_dir, image_name)
+    prompt = rng.choice(prompts)
+    neg_prompt = rng.choice(negative_prompts) if negative_prompts else ""
+    control_image_name = rng.choice(control_images)
+    seed = rng.randrange(2**31)
+    control_image_path = os.path.join(args.control_dir, control_image_name)
+    init_b64, control_b64, mask_b64, yolo_box, box_coords = await asyncio.to_thread(
+        prepare_inputs, image_path, control_image_path, prompt, rng, cache_init)
+    async with net:
+        output_imgs = await send_to_api(client, cache, init_b64, control_b64, mask_b64, prompt, neg_prompt, seed, n)
+
+    if output_imgs:
+        saved = await asyncio.get_running_loop().run_in_executor(
+            _save_pool, save_outputs, output_imgs, yolo_box, box_coords, args.output_dir, start)
+        for output_path, annotation_path in saved:
+            print(f"[✓] Kayıt edildi: {output_path} | Annotation: {annotation_path}")
+        return True
+    print(f"[✗] İşlenemedi: {image_name}")
+    return False
 
-def main():
+async def worker(client, cache, net, args, jobs, cache_init, prompts, negative_prompts, control_images):
+    # İşler ortak jobs yineleyicisinden sırayla çekiliyor. Hata veren iş atlanıp görselleri sayılıyor,
+    # API'ye hiç bağlanılamıyorsa (ConnectError) çalışma duruyor.
+    failed = 0
+    for start, image_name, job_seed in jobs:
+        n = min(args.batch_size, args.count - start)
+        try:
+            ok = await generate_batch(client, cache, net, args, start, n, image_name, random.Random(job_seed),
+                                      cache_init, prompts, negative_prompts, control_images)
+        except httpx.ConnectError:
+            raise
+        except Exception as e:
+            print(f"[✗] İşlenemedi: {image_name} ({e!r})")
+            ok = False
+        if not ok:
+            failed += n
+    return failed
+
+async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--count', type=int, required=True, help='Toplam üretilecek resim sayısı')
-    parser.add_argument('-bs', '--batch_size', type=int, default=1, help='Batch size')
-    parser.add_argument('-bc', '--batch_count', type=int, default=1, help='Batch count')
+    parser.add_argument('-bs', '--batch_size', type=int, default=1, help='Tek API çağrısında üretilecek görsel sayısı (aynı init + maske + prompt)')
     parser.add_argument('-p', '--prompt_file', type=str, default='prompt.txt', help='Prompt dosyası (virgülle ayrılmış)')
     parser.add_argument('-np', '--neg_prompt_file', type=str, default='negative_prompt.txt', help='Negative prompt dosyası')
     parser.add_argument('-o', '--output_dir', type=str, default='output', help='Çıktı klasörü')
     parser.add_argument('-i', '--input_dir', type=str, default='input', help='Giriş görselleri klasörü')
     parser.add_argument('-ci', '--control_dir', type=str, default='control', help='Control görselleri klasörü')
+    parser.add_argument('-j', '--concurrency', type=int, default=4, help='Aynı anda uçuşta olan API isteği sayısı')
+    parser.add_argument('--seed', type=int, default=0, help='Maske, prompt seçimi ve API seed\'leri için başlangıç değeri')
+    parser.add_argument('--cache_dir', type=str, default='.sd_cache', help='API sonuçları için disk önbelleği ("" → kapalı)')
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error('--concurrency en az 1 olmalı')
+    if args.batch_size < 1:
+        parser.error('--batch_size en az 1 olmalı')
 
     os.makedirs(args.output_dir, exist_ok=True)
     prompts = load_prompts(args.prompt_file)
     negative_prompts = load_prompts(args.neg_prompt_file)
     
-    images = [img for img in os.listdir(args.input_dir) if img.lower().endswith(('png', 'jpg', 'jpeg'))]
+    images = list_images(args.input_dir)
     if len(images) == 0:
         print("Giriş klasöründe görsel bulunamadı.")
         return
 
-    control_images = [img for img in os.listdir(args.control_dir) if img.lower().endswith(('png', 'jpg', 'jpeg'))]
+    control_images = list_images(args.control_dir)
     if len(control_images) == 0:
         print("Control klasöründe görsel bulunamadı.")
         return
 
-    for i, image_name in enumerate(itertools.islice(itertools.cycle(images), args.count)):
-        image_path = os.path.join(args.input_dir, image_name)
-        with Image.open(image_path).convert("RGB") as init_img:
-            prompt = random.choice(prompts)
-            neg_prompt = random.choice(negative_prompts) if negative_prompts else ""
-            mask, yolo_box, box_coords = create_mask(init_img, prompt)
-            control_image_name = random.choice(control_images)
-            control_image_path = os.path.join(args.control_dir, control_image_name)
-            with Image.open(control_image_path).convert("RGB") as control_img:
-                output_img = send_to_api(init_img, control_img, mask, prompt, neg_prompt)
-
-            if output_img:
-                # Üretilen resmin üzerine kırmızı kutu çiziliyor.
-                #draw = ImageDraw.Draw(output_img)
-                #draw.rectangle(box_coords, outline="red", width=3)
-
-                output_path = os.path.join(args.output_dir, f"out_{i+1}.png")
-                output_img.save(output_path)
-                # Kayıt edilen resmin yanına YOLO koordinatlarını içeren txt dosyası oluşturuluyor.
-                annotation_path = os.path.join(args.output_dir, f"out_{i+1}.txt")
-                with open(annotation_path, "w", encoding="utf-8") as f:
-                    f.write(" ".join(str(val) for val in yolo_box))
-                print(f"[✓] Kayıt edildi: {output_path} | Annotation: {annotation_path}")
-            else:
-                print(f"[✗] İşlenemedi: {image_name}")
+    # Worker'lar ortak yineleyiciden iş çekiyor, böylece bellekte iş başına görev birikmiyor.
+    # -j'den PREFETCH_DEPTH fazla worker var, sıradaki işler GPU beklenirken hazırlanıyor
+    starts = range(0, args.count, args.batch_size)
+    # İş seed'leri iş sırasıyla çekiliyor, sonuç -j'den bağımsız
+    rng = random.Random(args.seed)
+    jobs = ((start, image_name, rng.randrange(2**32))
+            for start, image_name in zip(starts, itertools.cycle(images)))
+    # cycle sırasında LRU ancak girdiler tekrar geliyorsa ve hepsi önbelleğe sığıyorsa isabet ediyor
+    cache_init = len(starts) > len(images) and len(images) <= ENCODE_CACHE_SIZE
+    net = asyncio.Semaphore(args.concurrency)
+    cache = diskcache.Cache(args.cache_dir) if args.cache_dir else None
+    try:
+        async with open_client(args.concurrency) as client:
+            workers = [asyncio.ensure_future(worker(client, cache, net, args, jobs, cache_init, prompts,
+                                                    negative_prompts, control_images))
+                       for _ in range(args.concurrency + PREFETCH_DEPTH)]
+            try:
+                failed = sum(await asyncio.gather(*workers))
+            except httpx.ConnectError:
+                # bağlantı hatasında net'i bekleyen worker'lar da durdurulmalı
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+    except httpx.ConnectError as e:
+        raise SystemExit(f"API'ye bağlanılamadı: {e}")
+    finally:
+        _save_pool.shutdown(wait=True)
+        if cache is not None:
+            cache.close()
+    if failed:
+        raise SystemExit(f"{failed} görsel üretilemedi")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
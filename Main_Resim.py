@@ -10,21 +10,85 @@ Advanced in‑painting pipeline for AUTOMATIC1111 WebUI
 
 import os
 import random
+import asyncio
 import argparse
-import requests
-from PIL import Image, ImageDraw, ImageFilter
+import httpx
+import orjson
+import ijson
+import numpy as np
+import cv2
+from PIL import Image
 import base64
 from io import BytesIO
 import itertools
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-API_URL = "http://127.0.0.1:7860/sdapi/v1/img2img"
+try:  # opsiyonel: libjpeg-turbo yoksa her şey PIL ile
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+API_BASE = "http://127.0.0.1:7860"
+IMG2IMG_PATH = "/sdapi/v1/img2img"
+JSON_HEADERS = {"Content-Type": "application/json"}
+ENCODE_CACHE_SIZE = 128  # base64 önbelleğindeki en fazla görsel
+_tls = threading.local()  # thread başına tek BytesIO
+_save_pool = ThreadPoolExecutor(max_workers=2)  # PNG kayıtları (to_thread havuzundan ayrı)
+IMAGE_EXTS = frozenset(("png", "jpg", "jpeg"))
+PREFETCH_DEPTH = 2  # GPU meşgulken girdileri önceden açılıp encode edilen iş sayısı
 
 # ---------------------------- yardımcı fonksiyonlar ----------------------------
 
+def open_client(concurrency: int) -> httpx.AsyncClient:
+    """Tüm istekler için tek, keep-alive bağlantı havuzu (istek başına yeni TCP yok).
+    WebUI işleri tek tek yürütür: yanıt, kuyrukta önündeki işleri de bekler."""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=API_BASE, headers=JSON_HEADERS, limits=limits,
+                             timeout=httpx.Timeout(120, read=120 * concurrency))
+
+
 def encode_image(image: Image.Image) -> str:
-    buf = BytesIO()
-    image.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode()
+    # seek(0) + üzerine yazma: kapasite korunur, geçerli kısım ilk tell() bayt
+    buf = getattr(_tls, "buf", None)
+    if buf is None:
+        buf = _tls.buf = BytesIO()
+    buf.seek(0)
+    if image.mode in ("1", "L"):  # maske: hızlı zlib PNG
+        image.save(buf, format="PNG", compress_level=1)
+    else:
+        image.save(buf, format="WEBP", lossless=True, quality=0, method=0)  # kayıpsız, PNG'den hızlı
+    size = buf.tell()
+    with buf.getbuffer() as view, view[:size] as data:  # view[:size] → önceki büyük görselin artığı okunmaz
+        return base64.b64encode(data).decode()
+
+
+def open_rgb(path: str) -> Image.Image:
+    """Görseli RGB açar; JPEG'ler varsa TurboJPEG ile çözülür, çözemezse PIL."""
+    if _tj is not None and path.rpartition(".")[2].lower() in ("jpg", "jpeg"):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return Image.fromarray(_tj.decode(data, pixel_format=TJPF_RGB))
+        except OSError:  # ör. CMYK JPEG
+            pass
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+@functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)
+def _encode_path_cached(path: str, mtime: float) -> str:
+    with open_rgb(path) as img:
+        return encode_image(img)
+
+
+def encode_path(path: str, cached: bool = True) -> str:
+    """Diskteki görseli encode eder; `cached` ise dosya değişmedikçe önbellekten döner."""
+    if not cached:
+        return _encode_path_cached.__wrapped__(path, 0.0)
+    return _encode_path_cached(path, os.path.getmtime(path))
 
 
 def load_prompts(path: str):
@@ -34,19 +98,28 @@ def load_prompts(path: str):
         return [p.strip() for p in f if p.strip()]
 
 
-def create_mask(img: Image.Image):
+def list_images(folder: str) -> list[str]:
+    """Klasördeki png/jpg/jpeg dosyaları; scandir'in önbellekli tür bilgisiyle, isme göre sıralı
+    (aynı --seed farklı dosya sistemlerinde de aynı sırayı görsün diye)."""
+    with os.scandir(folder) as entries:
+        return sorted(e.name for e in entries
+                      if e.is_file() and e.name.rpartition(".")[2].lower() in IMAGE_EXTS)
+
+
+def create_mask(img: Image.Image, rng: random.Random):
     """Rastgele boyutta kutu maskesi ve YOLO bbox döndürür."""
     w, h = img.size
     min_frac, max_frac = 0.2, 0.5
-    box_w = random.randint(int(w * min_frac), int(w * max_frac))
-    box_h = random.randint(int(h * min_frac), int(h * max_frac))
-    x0 = random.randint(0, w - box_w)
-    y0 = random.randint(0, h - box_h)
+    box_w = rng.randint(int(w * min_frac), int(w * max_frac))
+    box_h = rng.randint(int(h * min_frac), int(h * max_frac))
+    x0 = rng.randint(0, w - box_w)
+    y0 = rng.randint(0, h - box_h)
     x1, y1 = x0 + box_w, y0 + box_h
 
-    mask = Image.new("L", (w, h), 0)
-    ImageDraw.Draw(mask).rectangle([x0, y0, x1, y1], fill=255)
-    mask = mask.filter(ImageFilter.GaussianBlur(4))  # 4 px blur
+    arr = np.zeros((h, w), dtype=np.uint8)
+    arr[y0:y1 + 1, x0:x1 + 1] = 255  # ImageDraw.rectangle gibi uç noktalar dahil
+    arr = cv2.GaussianBlur(arr, (0, 0), sigmaX=4, borderType=cv2.BORDER_REPLICATE)  # 4 px blur
+    mask = Image.fromarray(arr)  # 2 boyutlu uint8 → "L" modu
 
     # YOLO (cls, cx, cy, w, h) normalised
     cx, cy = ((x0 + x1) / 2) / w, ((y0 + y1) / 2) / h
@@ -56,35 +129,102 @@ def create_mask(img: Image.Image):
 
 def save_side_by_side(orig: Image.Image, gen: Image.Image, out_path: str):
     """Kaynak ve üretilen görselleri yan yana yapıştırıp kaydeder."""
-    w1, h1 = orig.size
-    w2, h2 = gen.size
-    canvas = Image.new("RGB", (w1 + w2, max(h1, h2)))
-    canvas.paste(orig, (0, 0))
-    canvas.paste(gen, (w1, 0))
-    canvas.save(out_path)
+    if gen.mode != "RGB":
+        gen = gen.convert("RGB")
+    if orig.mode == "RGB" and orig.height == gen.height:
+        # Aynı yükseklik: satırları tek np.concatenate ile birleştir (paste yok)
+        canvas = Image.fromarray(np.concatenate([np.asarray(orig), np.asarray(gen)], axis=1))
+    else:
+        w1, h1 = orig.size
+        w2, h2 = gen.size
+        canvas = Image.new("RGB", (w1 + w2, max(h1, h2)))
+        canvas.paste(orig, (0, 0))
+        canvas.paste(gen, (w1, 0))
+    canvas.save(out_path, format="PNG", compress_level=1)  # karşılaştırma karesi, hız > boyut
+
+
+# ---------------------------- pipeline aşamaları ----------------------------
+# hazırla (thread) → API (async) → çöz + kaydet (thread)
+
+def prepare_inputs(path: str, ctrl_path: str, rng: random.Random, cache_init: bool):
+    """Görseli açar, maskeyi üretir ve tüm girdileri base64'ler."""
+    init_img = open_rgb(path)
+    mask, yolo, _ = create_mask(init_img, rng)
+    return init_img, encode_path(path, cache_init), encode_path(ctrl_path), encode_image(mask), yolo
+
+
+def decode_image(img_data: str) -> Image.Image:
+    img_b64 = img_data.split(",", 1)[1]
+    return Image.open(BytesIO(base64.b64decode(img_b64)))
+
+
+def save_outputs(init_img: Image.Image, out_img: Image.Image, yolo: tuple, output_dir: str, i: int):
+    """out_i.png + cmp_i.png + out_i.txt yazar; log için iki PNG yolunu döndürür."""
+    with init_img:
+        out_path = os.path.join(output_dir, f"out_{i}.png")
+        out_img.save(out_path, format="PNG", compress_level=1)
+
+        cmp_path = os.path.join(output_dir, f"cmp_{i}.png")
+        save_side_by_side(init_img, out_img, cmp_path)
+
+    with open(os.path.join(output_dir, f"out_{i}.txt"), "w", encoding="utf-8") as f:
+        f.write(" ".join(str(v) for v in yolo))
+    return out_path, cmp_path
 
 
 # ---------------------------- API çağrısı ----------------------------
 
-def send_to_api(init_img: Image.Image, ctrl_line: Image.Image, ctrl_color: Image.Image,
-                ctrl_depth: Image.Image, mask_img: Image.Image,
-                prompt: str, neg_prompt: str):
+class _StreamReader:
+    """httpx yanıt akışını ijson'un beklediği async read() arayüzüne uyarlar."""
+
+    def __init__(self, resp: httpx.Response):
+        self._chunks = resp.aiter_bytes()
+
+    async def read(self, n: int = -1) -> bytes:
+        if n == 0:  # ijson bytes/str ayrımı için read(0) çağırıyor
+            return b""
+        return await anext(self._chunks, b"")
+
+    async def drain(self):
+        async for _ in self._chunks:
+            pass
+
+
+async def read_first_image(resp: httpx.Response) -> str:
+    """İlk görseli gövde gelirken ayrıştırır. Kalan kısım (ControlNet detect
+    map'leri, info) tokenize edilmeden okunup atılır; bağlantı havuza döner."""
+    reader = _StreamReader(resp)
+    img_data = None
+    async for img_data in ijson.items(reader, "images.item"):
+        break
+    await reader.drain()
+    if img_data is None:
+        raise ValueError("API yanıtında görsel yok")
+    return img_data
+
+
+async def send_to_api(client: httpx.AsyncClient, init_b64: str, ctrl_line_b64: str, ctrl_ref_b64: str,
+                      ctrl_depth_b64: str, mask_b64: str, size: tuple[int, int],
+                      prompt: str, neg_prompt: str, seed: int):
+    """Tüm görseller önceden base64'lenmiş gelir; aynı görsel birden fazla
+    ünitede kullanılıyorsa aynı string tekrar geçirilir (yeniden encode yok)."""
     payload = {
-        "init_images": [encode_image(init_img)],
-        "mask": encode_image(mask_img),
+        "init_images": [init_b64],
+        "mask": mask_b64,
         "denoising_strength": 0.6,
         "inpainting_fill": 1,  # latent noise
         "inpaint_full_res": False,
         "sampler_name": "Euler a",
         "steps": 22,
         "cfg_scale": 7,
+        "seed": seed,
         "prompt": prompt,
         "negative_prompt": neg_prompt,
-        "width": init_img.size[0],
-        "height": init_img.size[1],
+        "width": size[0],
+        "height": size[1],
         "controlnet_units": [
             {  # 0 → lineart (ateş maskesi)
-                "input_image": encode_image(ctrl_line),
+                "input_image": ctrl_line_b64,
                 "module": "lineart",
                 "model": "control_v11p_sd15_lineart [43d4be0d]",
                 "weight": 1.0,
@@ -92,7 +232,7 @@ def send_to_api(init_img: Image.Image, ctrl_line: Image.Image, ctrl_color: Image
                 "low_vram": True,
             },
             {  # 1 → color reference
-                "input_image": encode_image(ctrl_color),
+                "input_image": ctrl_ref_b64,
                 "module": "reference_only",
                 "model": "control_v1p_sd15_color [f19423b0]",
                 "weight": 0.8,
@@ -100,7 +240,7 @@ def send_to_api(init_img: Image.Image, ctrl_line: Image.Image, ctrl_color: Image
                 "low_vram": True,
             },
             {  # 2 → depth
-                "input_image": encode_image(ctrl_depth),
+                "input_image": ctrl_depth_b64,
                 "module": "depth",
                 "model": "control_v11p_sd15_depth [cfd03158]",
                 "weight": 0.5,
@@ -109,15 +249,54 @@ def send_to_api(init_img: Image.Image, ctrl_line: Image.Image, ctrl_color: Image
             },
         ],
     }
-    r = requests.post(API_URL, json=payload, timeout=120)
-    r.raise_for_status()
-    img_b64 = r.json()["images"][0].split(",", 1)[1]
-    return Image.open(BytesIO(base64.b64decode(img_b64)))
+    async with client.stream("POST", IMG2IMG_PATH, content=orjson.dumps(payload)) as r:
+        r.raise_for_status()
+        img_data = await read_first_image(r)
+    return await asyncio.to_thread(decode_image, img_data)
 
 
 # ---------------------------- ana döngü ----------------------------
 
-def main():
+async def generate_one(client: httpx.AsyncClient, net: asyncio.Semaphore, args, i: int, name: str,
+                       rng: random.Random, cache_init: bool, prompts: list, neg_prompts: list, ctrls: list):
+    """net: uçuştaki istek sınırı; hazırlık ve kayıt onun dışında.
+    rng işe özel → zamanlamadan bağımsız, aynı --seed aynı çıktı."""
+    path = os.path.join(args.input_dir, name)
+    prompt = rng.choice(prompts)
+    neg = rng.choice(neg_prompts) if neg_prompts else ""
+    ctrl_name = rng.choice(ctrls)
+    seed = rng.randrange(2**31)
+    ctrl_path = os.path.join(args.control_dir, ctrl_name)
+
+    init_img, init_b64, ctrl_b64, mask_b64, yolo = await asyncio.to_thread(
+        prepare_inputs, path, ctrl_path, rng, cache_init)
+    # init görseli 3 yerde (init + color + depth) kullanılıyor → tek encode
+    async with net:
+        out_img = await send_to_api(client, init_b64, ctrl_b64, init_b64, init_b64, mask_b64,
+                                    init_img.size, prompt, neg, seed)
+    out_path, cmp_path = await asyncio.get_running_loop().run_in_executor(
+        _save_pool, save_outputs, init_img, out_img, yolo, args.output_dir, i)
+    print(f"[✓] {out_path}  +  {cmp_path}")
+
+
+async def worker(client: httpx.AsyncClient, net: asyncio.Semaphore, args, jobs, cache_init: bool,
+                 prompts: list, neg_prompts: list, ctrls: list) -> int:
+    """Ortak `jobs` yineleyicisinden sırayla iş çeker; başarısız iş sayısını döndürür.
+    Hatalı iş raporlanıp atlanır, API'ye bağlanılamıyorsa (ConnectError) çalışma durur."""
+    failed = 0
+    for i, name, job_seed in jobs:
+        try:
+            await generate_one(client, net, args, i, name, random.Random(job_seed), cache_init,
+                               prompts, neg_prompts, ctrls)
+        except httpx.ConnectError:
+            raise
+        except Exception as e:
+            failed += 1
+            print(f"[✗] {name} → out_{i}: {e!r}")
+    return failed
+
+
+async def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("-c", "--count", type=int, required=True)
     ap.add_argument("-p", "--prompt_file", default="prompt.txt")
@@ -125,41 +304,50 @@ def main():
     ap.add_argument("-o", "--output_dir", default="output")
     ap.add_argument("-i", "--input_dir", default="input")
     ap.add_argument("-ci", "--control_dir", default="control")
+    ap.add_argument("-j", "--concurrency", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
     args = ap.parse_args()
+    if args.concurrency < 1:
+        ap.error("--concurrency en az 1 olmalı")
 
     os.makedirs(args.output_dir, exist_ok=True)
     prompts = load_prompts(args.prompt_file)
     neg_prompts = load_prompts(args.neg_prompt_file)
 
-    imgs = [f for f in os.listdir(args.input_dir) if f.lower().endswith(("png", "jpg", "jpeg"))]
-    ctrls = [f for f in os.listdir(args.control_dir) if f.lower().endswith(("png", "jpg", "jpeg"))]
+    imgs = list_images(args.input_dir)
+    ctrls = list_images(args.control_dir)
     if not imgs or not ctrls:
         print("Gerekli giriş/ control görselleri bulunamadı!")
         return
 
-    for i, name in enumerate(itertools.islice(itertools.cycle(imgs), args.count), 1):
-        path = os.path.join(args.input_dir, name)
-        with Image.open(path).convert("RGB") as init_img:
-            prompt = random.choice(prompts)
-            neg = random.choice(neg_prompts) if neg_prompts else ""
-            mask, yolo, _ = create_mask(init_img)
-
-            ctrl_name = random.choice(ctrls)
-            ctrl_path = os.path.join(args.control_dir, ctrl_name)
-            with Image.open(ctrl_path).convert("RGB") as ctrl_img:
-                out_img = send_to_api(init_img, ctrl_img, init_img, init_img, mask, prompt, neg)
-
-            out_path = os.path.join(args.output_dir, f"out_{i}.png")
-            out_img.save(out_path)
-
-            cmp_path = os.path.join(args.output_dir, f"cmp_{i}.png")
-            save_side_by_side(init_img, out_img, cmp_path)
-
-            with open(os.path.join(args.output_dir, f"out_{i}.txt"), "w", encoding="utf-8") as f:
-                f.write(" ".join(str(v) for v in yolo))
-
-            print(f"[✓] {out_path}  +  {cmp_path}")
+    # İş seed'leri iş sırasıyla çekilir → sonuç -j'den bağımsız
+    rng = random.Random(args.seed)
+    # Worker'lar ortak yineleyiciden iş çeker; -j'den PREFETCH_DEPTH fazla olduklarından
+    # sıradaki işlerin girdileri GPU beklenirken hazırlanır
+    jobs = ((i, name, rng.randrange(2**32))
+            for i, name in enumerate(itertools.islice(itertools.cycle(imgs), args.count), 1))
+    # cycle sırasında LRU ancak girdiler tekrar geliyorsa ve hepsi önbelleğe sığıyorsa isabet eder
+    cache_init = args.count > len(imgs) and len(imgs) <= ENCODE_CACHE_SIZE
+    net = asyncio.Semaphore(args.concurrency)
+    try:
+        async with open_client(args.concurrency) as client:
+            workers = [asyncio.ensure_future(worker(client, net, args, jobs, cache_init, prompts, neg_prompts, ctrls))
+                       for _ in range(args.concurrency + PREFETCH_DEPTH)]
+            try:
+                failed = sum(await asyncio.gather(*workers))
+            except httpx.ConnectError:
+                # net'i bekleyen worker'lar istemci kapanmadan durdurulur
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+    except httpx.ConnectError as e:
+        raise SystemExit(f"API'ye bağlanılamadı: {e}")
+    finally:
+        _save_pool.shutdown(wait=True)
+    if failed:
+        raise SystemExit(f"{failed} görsel üretilemedi")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())